@@ -2,11 +2,17 @@
 # dynamic_jira_etl.py
 # =========================
 
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-import json
+import orjson
+import httpx
 from loguru import logger
 from datetime import datetime
-from collections import defaultdict
+from functools import lru_cache
+from itertools import islice
+from typing import NamedTuple, Optional
 from sqlalchemy import create_engine, text
 import pandas as pd
 from requests.adapters import HTTPAdapter
@@ -16,11 +22,48 @@ from urllib3.util.retry import Retry
 # =========================
 # CONFIG DYNAMIC TABLES
 # =========================
+# Rutas ya partidas: evita path.split(".") por issue y tabla
 DYNAMIC_TABLES = {
-    "jira_subtasks": "fields.subtasks",
-    "jira_changelog": "changelog.histories"
+    "jira_subtasks": ("fields", "subtasks"),
+    "jira_changelog": ("changelog", "histories")
 }
 
+# Columna normalizada -> columna en jira_changelog_flat
+CHANGELOG_FLAT_COLUMNS = {
+    "issue_key": "issue_key",
+    "author.displayName": "author_name",
+    "author.accountId": "author_account_id",
+    "created": "created",
+    "field": "field",
+    "fromString": "from",
+    "toString": "to"
+}
+
+# Filas por lote en las cargas dinámicas
+CHUNK_SIZE = 1000
+
+
+# =========================
+# CONFIG HTTP
+# =========================
+# 429: rate limit de Jira Cloud, se reintenta respetando Retry-After
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Respuestas JSON comprimidas: requests/httpx descomprimen solos
+HTTP_HEADERS = {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+
+
+def _json(resp):
+    return orjson.loads(resp.content)
+
+
+def _retry_after(resp, default):
+    """Seconds to wait from a Retry-After header, else the default backoff"""
+    try:
+        return max(float(resp.headers["Retry-After"]), 0)
+    except (KeyError, ValueError):
+        return default
+
 
 # =========================
 # FETCH JIRA ISSUES
@@ -34,143 +77,303 @@ class FetchJiraIssues:
         self.jira_issues_jql = config.jira_issues_jql
         self.jira_epics_jql = config.jira_epics_jql
         self.results_per_page = 100
+        self.max_concurrency = 20
 
         # Session con retry automático (MEJORA CRÍTICA)
         self.session = requests.Session()
-        retries = Retry(total=5, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504])
-        self.session.mount("https://", HTTPAdapter(max_retries=retries))
+        self.session.auth = (self.jira_username, self.jira_api_key)
+        self.session.headers.update(HTTP_HEADERS)
+        retries = Retry(total=5, backoff_factor=0.3, status_forcelist=RETRY_STATUSES)
+        self.session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                                                   max_retries=retries))
 
     def get_issues(self):
         return self.__fetch_all_results(self.jira_issues_jql)
 
 
 
-    def __fetch_all_results(self, jql):
-        # 1) Fetch keys only
-        keys = []
-        start_at = 0
-
-        while True:
-            params = {
-                "jql": jql,
-                "fields": "key",
-                "maxResults": self.results_per_page,
-                "startAt": start_at
-            }
-
-            r = self.session.get(self.jira_endpoint,
-                                 params=params,
-                                 auth=(self.jira_username, self.jira_api_key))
-
-            data = r.json()
-            issues = data.get("issues", [])
-            keys.extend([i["key"] for i in issues])
-
-            # FIX: Jira Cloud no siempre envía isLast
-            if len(issues) < self.results_per_page:
-                break
-
-            start_at += len(issues)
-
-        logger.info(f"Found {len(keys)} issues")
-
-        # 2) Fetch full issues
-        issue_arr = []
-        base = self.jira_endpoint.rsplit("/search", 1)[0]
-
-        for key in keys:
-            url = f"{base}/issue/{key}"
-            params = {"expand": "names,changelog,renderedFields"}
-            r = self.session.get(url, params=params,
-                                 auth=(self.jira_username, self.jira_api_key))
-
-            if r.status_code == 200:
-                issue_arr.append(r.json())
-                logger.info(f"Found {r.json()} issues")
-            else:
-                logger.warning(f"Failed {key}: {r.status_code}")
+    def __search_params(self, jql, start_at=None, validate=False, next_page_token=None):
+        params = {
+            "jql": jql,
+            "fields": "*all",
+            "expand": "changelog,renderedFields",
+            "maxResults": self.results_per_page
+        }
+        # /search pagina por startAt; /search/jql por nextPageToken
+        if start_at is not None:
+            params["startAt"] = start_at
+        if next_page_token is not None:
+            params["nextPageToken"] = next_page_token
+        # La JQL solo se valida una vez, en la primera página
+        if validate:
+            params["validateQuery"] = "warn"
+        return params
 
+    def __fetch_all_results(self, jql):
+        # 1) Primera página: issues completos + total
+        data = self.__get_search_page(self.__search_params(jql, validate=True))
+        for msg in data.get("warningMessages", []):
+            logger.warning(f"JQL: {msg}")
+        issue_arr = data.get("issues", [])
+
+        # /search/jql no devuelve total: paginación secuencial por token
+        if "total" not in data:
+            while not data.get("isLast", True):
+                token = data.get("nextPageToken")
+                if not token:
+                    raise RuntimeError(f"Search page has isLast=false but no nextPageToken for JQL: {jql}")
+                data = self.__get_search_page(self.__search_params(jql, next_page_token=token))
+                issue_arr.extend(data.get("issues", []))
+
+            logger.info(f"Fetched {len(issue_arr)} issues")
+            return issue_arr
+
+        total = data["total"]
+        logger.info(f"Found {total} issues")
+
+        # 2) Resto de páginas (concurrent). Jira puede recortar maxResults
+        page_size = data.get("maxResults") or self.results_per_page
+        starts = range(len(issue_arr), total, page_size)
+        if issue_arr and starts:
+            issue_arr.extend(asyncio.run(self.__fetch_pages(jql, starts)))
+
+        # Con offsets, un issue creado/movido durante la descarga puede repetirse
+        issue_arr = list({issue["key"]: issue for issue in issue_arr}.values())
+
+        logger.info(f"Fetched {len(issue_arr)} issues")
+        # Nunca cargar datos parciales: las tablas se reemplazan enteras.
+        # Más issues que total es normal si se crearon durante la descarga
+        if len(issue_arr) < total:
+            raise RuntimeError(f"Fetched {len(issue_arr)} of {total} issues for JQL: {jql}")
         return issue_arr
 
+    def __get_search_page(self, params):
+        r = self.session.get(self.jira_endpoint, params=params)
+        r.raise_for_status()
+        return _json(r)
+
+    async def __fetch_pages(self, jql, starts):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        # HTTP/2: las páginas se multiplexan sobre pocas conexiones
+        limits = httpx.Limits(max_connections=self.max_concurrency,
+                              max_keepalive_connections=self.max_concurrency)
+
+        async with httpx.AsyncClient(http2=True, auth=(self.jira_username, self.jira_api_key),
+                                     headers=HTTP_HEADERS, limits=limits,
+                                     timeout=httpx.Timeout(60.0)) as client:
+            pages = await asyncio.gather(
+                *[self.__fetch_page(client, semaphore, jql, start_at) for start_at in starts]
+            )
+
+        return [issue for page in pages for issue in page]
+
+    async def __fetch_page(self, client, semaphore, jql, start_at, retries=5):
+        params = self.__search_params(jql, start_at)
+
+        async with semaphore:
+            for attempt in range(retries + 1):
+                delay = 0.3 * (2 ** attempt)
+                try:
+                    resp = await client.get(self.jira_endpoint, params=params)
+                except httpx.TransportError as e:
+                    # Igual que urllib3 Retry: errores de conexión/lectura se reintentan
+                    if attempt == retries:
+                        raise
+                    logger.warning(f"Retrying page startAt={start_at}: {e!r}")
+                else:
+                    if resp.is_success:
+                        return orjson.loads(resp.content).get("issues", [])
+                    if resp.status_code not in RETRY_STATUSES or attempt == retries:
+                        logger.error(f"Failed page startAt={start_at}: {resp.status_code}")
+                        resp.raise_for_status()
+                    delay = _retry_after(resp, delay)
+                await asyncio.sleep(delay)
+
 
 # =========================
 # TRANSFORM STATIC CORE TABLE
 # =========================
+class IssueRow(NamedTuple):
+    key: Optional[str]
+    summary: Optional[str]
+    status: Optional[str]
+    project: Optional[str]
+    issuetype: Optional[str]
+    priority: Optional[str]
+    assignee: Optional[str]
+    description: Optional[str]
+    created: Optional[str]
+    updated: Optional[str]
+
+
 class TransformData:
 
+    columns = list(IssueRow._fields)
+
     def construct_dataframe(self, issues_json):
         issue_list = [self.make_issue_body(issue) for issue in issues_json]
-        return pd.json_normalize(issue_list)
+        return pd.DataFrame(issue_list, columns=self.columns)
 
     def make_issue_body(self, issue):
-        f = issue.get("fields", {})
-        body = defaultdict(None)
-
-        body["key"] = issue.get("key")
-        body["summary"] = f.get("summary")
-        body["status"] = f.get("status", {}).get("name")
-        body["project"] = f.get("project", {}).get("name")
-        body["issuetype"] = f.get("issuetype", {}).get("name")
-        body["priority"] = (f.get("priority") or {}).get("name")
-        body["assignee"] = (f.get("assignee") or {}).get("displayName")
-        body["description"] =(issue.get("renderedFields") or {}).get("description")
-        body["created"] = f.get("created")
-        body["updated"] = f.get("updated")
-
-        return body
+        f = issue.get("fields") or {}
+        status = f.get("status") or {}
+        project = f.get("project") or {}
+        issuetype = f.get("issuetype") or {}
+        priority = f.get("priority") or {}
+        assignee = f.get("assignee") or {}
+        rendered = issue.get("renderedFields") or {}
+
+        return IssueRow(
+            key=issue.get("key"),
+            summary=f.get("summary"),
+            status=status.get("name"),
+            project=project.get("name"),
+            issuetype=issuetype.get("name"),
+            priority=priority.get("name"),
+            assignee=assignee.get("displayName"),
+            description=rendered.get("description"),
+            created=f.get("created"),
+            updated=f.get("updated"),
+        )
 
 
 # =========================
 # DYNAMIC EXTRACTION
 # =========================
-def extract_path(obj, path):
+def extract_path(obj, parts):
     """Safe deep path extraction"""
-    for p in path.split("."):
-        if not isinstance(obj, dict):
-            return []
-        obj = obj.get(p, [])
+    for p in parts:
+        obj = obj.get(p) if isinstance(obj, dict) else None
         if obj is None:
             return []
     return obj
 
 
-def infer_columns(rows):
-    cols = set()
-    for r in rows:
-        if isinstance(r, dict):
-            cols.update(r.keys())
-    return list(cols)
+def iter_rows(issues_json, path):
+    """Yield dynamic rows tagged with their issue key"""
+    for issue in issues_json:
+        rows = extract_path(issue, path)
+        if isinstance(rows, list):
+            for r in rows:
+                if isinstance(r, dict):
+                    r["issue_key"] = issue["key"]
+                    yield r
 
 
-def drop_and_create_table(engine, table, columns):
+def flatten_changelog(rows):
+    """One row per changelog item (not only items[0])"""
+    rows = [r for r in rows if isinstance(r.get("items"), list)]
+    if not rows:
+        return pd.DataFrame(columns=list(CHANGELOG_FLAT_COLUMNS.values()))
+
+    flat = pd.json_normalize(
+        rows,
+        record_path="items",
+        meta=["issue_key", ["author", "displayName"], ["author", "accountId"], "created"],
+        errors="ignore",
+    )
+    flat = flat.reindex(columns=list(CHANGELOG_FLAT_COLUMNS)).rename(columns=CHANGELOG_FLAT_COLUMNS)
+    return flat.astype(object).where(flat.notna(), None)
+
+
+def iter_changelog_flat(rows):
+    for chunk in chunked(rows):
+        yield from flatten_changelog(chunk).to_dict("records")
+
+
+def chunked(rows, size=CHUNK_SIZE):
+    it = iter(rows)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def collect_rows(issues_json, path):
+    """Single pass: rows for path plus the union of their columns"""
+    cols = {}
+    rows = []
+    for r in iter_rows(issues_json, path):
+        cols.update(dict.fromkeys(r))
+        rows.append(r)
+    return list(cols), rows
+
+
+def drop_and_create_table_conn(conn, table, columns):
     # Escapar columnas problemáticas
     cols_sql = ", ".join([f"\"{c}\" TEXT" for c in columns])
     sql = f'DROP TABLE IF EXISTS "{table}"; CREATE TABLE "{table}" ({cols_sql});'
 
-    with engine.begin() as conn:
-        conn.exec_driver_sql(sql)
+    conn.exec_driver_sql(sql)
 
     logger.info(f"Created table {table}")
 
 
-def insert_rows(engine, table, columns, rows):
-    with engine.begin() as conn:
-        for r in rows:
-            clean = {}
-            for c in columns:
-                v = r.get(c)
+def nested_columns(rows, columns):
+    """Columns with at least one dict/list cell in rows.
+
+    Columns may mix types (str in one row, dict in another): callers still
+    check each cell, this only skips the columns that never need JSON.
+    """
+    return {c for c in columns
+            if any(isinstance(r.get(c), (dict, list)) for r in rows)}
+
+
+def dump_json(v):
+    return None if v is None else orjson.dumps(v).decode("utf-8")
+
+
+def encode_cell(v):
+    """dict/list -> JSON text; any other value passes through unchanged"""
+    return dump_json(v) if isinstance(v, (dict, list)) else v
+
+
+@lru_cache(maxsize=None)
+def insert_statement(table, columns):
+    """Compiled INSERT for (table, columns); columns must be a tuple"""
+    placeholders = ",".join([f":{c}" for c in columns])
+    col_sql = ",".join([f"\"{c}\"" for c in columns])
+    return text(f'INSERT INTO "{table}" ({col_sql}) VALUES ({placeholders})')
+
+
+def insert_rows_conn(conn, table, columns, rows):
+    """Stream rows into table in CHUNK_SIZE batches; returns the row count"""
+    postgres = conn.dialect.name == "postgresql"
+    stmt = None if postgres else insert_statement(table, tuple(columns))
+
+    count = 0
+    for chunk in chunked(rows):
+        if postgres:
+            copy_rows(conn, table, columns, chunk)
+        else:
+            # FIX CRÍTICO: dict/list se guardan como JSON
+            json_cols = nested_columns(chunk, columns)
+            cleaned = [
+                {c: (encode_cell(r.get(c)) if c in json_cols else r.get(c)) for c in columns}
+                for r in chunk
+            ]
+            conn.execute(stmt, cleaned)
+        count += len(chunk)
+
+    return count
+
 
-                # FIX CRÍTICO
-                if isinstance(v, (dict, list)):
-                    v = json.dumps(v, ensure_ascii=False)
+def copy_rows(conn, table, columns, rows):
+    """Bulk load via PostgreSQL COPY"""
+    # dtype=object: sin casts a float en columnas con huecos
+    df = pd.DataFrame([[r.get(c) for c in columns] for r in rows],
+                      columns=columns, dtype=object)
+    # Serializar solo las columnas anidadas, columna a columna
+    for c in nested_columns(rows, columns):
+        df[c] = df[c].map(encode_cell)
 
-                clean[c] = v
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, na_rep="\\N")
+    buf.seek(0)
 
-            placeholders = ",".join([f":{c}" for c in columns])
-            col_sql = ",".join([f"\"{c}\"" for c in columns])
-            sql = f'INSERT INTO "{table}" ({col_sql}) VALUES ({placeholders})'
+    col_sql = ",".join([f"\"{c}\"" for c in columns])
+    sql = f'COPY "{table}" ({col_sql}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')'
 
-            conn.execute(text(sql), clean)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(sql, buf)
 
 
 # =========================
@@ -179,53 +382,44 @@ def insert_rows(engine, table, columns, rows):
 class Database:
 
     def __init__(self, Config):
-        self.engine = create_engine(Config.db_uri, pool_pre_ping=True)
+        self.engine = create_engine(Config.db_uri, pool_pre_ping=True, pool_size=8)
 
     def upload_core(self, df, table):
         df.to_sql(table, self.engine, if_exists="replace", index=False)
         logger.info(f"Uploaded {len(df)} rows to {table}")
 
     def upload_dynamic(self, issues_json):
-            for table, path in DYNAMIC_TABLES.items():
-                logger.info(f"Extracting dynamic table {table} from {path}")
-                all_rows = []
-                for issue in issues_json:
-                    rows = extract_path(issue, path)
-                    if isinstance(rows, list):
-                        for r in rows:
-                            if isinstance(r, dict):
-                                r["issue_key"] = issue["key"]
-                                all_rows.append(r)
-
-                if not all_rows:
-                    logger.warning(f"No rows for {table}")
-                    continue
-
-                # Tabla dinámica original
-                cols = infer_columns(all_rows)
-                drop_and_create_table(self.engine, table, cols)
-                insert_rows(self.engine, table, cols, all_rows)
-
-                # ✨ Tabla plana para changelog
-                if table == "jira_changelog":
-                    flat_rows = []
-                    for r in all_rows:
-                        flat = {
-                            "issue_key": r.get("issue_key"),
-                            "author_name": r.get("author", {}).get("displayName") if isinstance(r.get("author"), dict) else None,
-                            "author_account_id": r.get("author", {}).get("accountId") if isinstance(r.get("author"), dict) else None,
-                            "created": r.get("created"),
-                            "field": r.get("items", [{}])[0].get("field") if isinstance(r.get("items"), list) else None,
-                            "from": r.get("items", [{}])[0].get("fromString") if isinstance(r.get("items"), list) else None,
-                            "to": r.get("items", [{}])[0].get("toString") if isinstance(r.get("items"), list) else None,
-                        }
-                        flat_rows.append(flat)
-
-                    flat_cols = list(flat_rows[0].keys()) if flat_rows else []
-                    if flat_rows:
-                        drop_and_create_table(self.engine, "jira_changelog_flat", flat_cols)
-                        insert_rows(self.engine, "jira_changelog_flat", flat_cols, flat_rows)
-                        logger.info(f"Uploaded flattened {len(flat_rows)} rows to jira_changelog_flat")
+        # Cada tabla dinámica es independiente: una conexión por hilo
+        with ThreadPoolExecutor(max_workers=len(DYNAMIC_TABLES)) as ex:
+            futures = [ex.submit(self._process_dynamic_table, table, path, issues_json)
+                       for table, path in DYNAMIC_TABLES.items()]
+            for f in as_completed(futures):
+                f.result()
+
+    def _process_dynamic_table(self, table, path, issues_json):
+        logger.info(f"Extracting dynamic table {table} from {'.'.join(path)}")
+        cols, rows = collect_rows(issues_json, path)
+
+        if not cols:
+            logger.warning(f"No rows for {table}")
+            return
+
+        # DDL + carga en una única transacción por tabla
+        with self.engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                conn.exec_driver_sql("SET LOCAL synchronous_commit = off")
+
+            # Tabla dinámica original
+            drop_and_create_table_conn(conn, table, cols)
+            insert_rows_conn(conn, table, cols, rows)
+
+            # ✨ Tabla plana para changelog
+            if table == "jira_changelog":
+                flat_cols = list(CHANGELOG_FLAT_COLUMNS.values())
+                drop_and_create_table_conn(conn, "jira_changelog_flat", flat_cols)
+                count = insert_rows_conn(conn, "jira_changelog_flat", flat_cols,
+                                         iter_changelog_flat(rows))
+                logger.info(f"Uploaded flattened {count} rows to jira_changelog_flat")
 
 
 # =========================